@@ -8,6 +8,9 @@ dotenv.config();
 console.log("🧑🏻‍🏭 Worker Started");
 let videoCount = 1;
 
+const DIFF_DUB_TIMEOUT_MS = 30 * 60 * 1000;
+const DIFF_DUB_POLL_MS = 5000;
+
 const connection = {
   host: process.env.REDIS_HOST,
   port: Number(process.env.REDIS_PORT),
@@ -86,8 +89,23 @@ const worker = new Worker(
     THV.append("reference_video", videoFile);
 
     console.log("🚀 Sending data to Diffdub !");
-    const videoRes = await axios.post(process.env.DIFF_DUB_URL!, THV, {
-      timeout: 30 * 60 * 1000,
+    const jobsUrl = new URL("/jobs", process.env.DIFF_DUB_URL!).toString();
+    const submitRes = await axios.post(jobsUrl, THV);
+    const diffdubJobId: string = submitRes.data.job_id;
+    console.log(`🚀 Diffdub job ${diffdubJobId} queued`);
+
+    const deadline = Date.now() + DIFF_DUB_TIMEOUT_MS;
+    let status = submitRes.data;
+    while (status.status !== "done") {
+      if (status.status === "failed") throw new Error(`Diffdub failed: ${status.error}`);
+      if (Date.now() > deadline) throw new Error(`Diffdub job ${diffdubJobId} timed out`);
+
+      await new Promise((resolve) => setTimeout(resolve, DIFF_DUB_POLL_MS));
+      status = (await axios.get(`${jobsUrl}/${diffdubJobId}`)).data;
+      await job.updateProgress({ stage: status.stage, progress: status.progress });
+    }
+
+    const videoRes = await axios.get(`${jobsUrl}/${diffdubJobId}/result`, {
       responseType: "arraybuffer",
     });
 
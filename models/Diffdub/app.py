@@ -1,19 +1,437 @@
-from flask import Flask, request, jsonify, send_file
-from transformers import HubertModel, Wav2Vec2Processor
+import os
+import sys
+# Shared service code lives in models/common; AVATAR_LAB_MODELS points at the models/ directory
+# when app.py runs from inside a model checkout
+MODELS_DIR = os.environ.get('AVATAR_LAB_MODELS', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# Appended, not prepended, so it never shadows the model checkout's own modules
+if os.path.isdir(os.path.join(MODELS_DIR, 'common')):
+    sys.path.append(MODELS_DIR)
+from flask import Flask, Response, request, jsonify, send_file
+from prometheus_client import Gauge
+from transformers import HubertModel, Wav2Vec2FeatureExtractor
+from concurrent.futures import ThreadPoolExecutor
 from demo import demo_pipeline
+from common.model_service import ModelService
 from pyngrok import ngrok
-import os
+import io
+import math
+import time
+import uuid
+import queue
+import shutil
+import threading
+import subprocess
 import torch
 import numpy as np
 import torchaudio
-from audio_features import extract_audio_features
 
 
 app = Flask(__name__)
+service = ModelService(app, "diffdub")
+startup_stage = service.startup_stage
+STAGE_SECONDS = service.stage_seconds
+BYTES_OUT = service.bytes_out
 
 
 REQUESTS = 'Requests'
 OUTPUTS = 'Outputs'
+HUBERT_MODEL_PATH = 'weights/chinese-hubert-large'
+STAGE1_CHECKPOINT = "assets/checkpoints/stage1_state_dict.ckpt"
+STAGE2_CHECKPOINT = "assets/checkpoints/stage2_state_dict.ckpt"
+DEVICE = os.environ.get('DIFFDUB_DEVICE', 'cuda:0')
+os.makedirs(REQUESTS, exist_ok=True)
+os.makedirs(OUTPUTS, exist_ok=True)
+
+# Frame rate DiffDub works at (HuBERT features are 50Hz, two per video frame)
+REFERENCE_FPS = 25
+
+# Number of generations allowed to run at the same time on this box
+MAX_CONCURRENT_JOBS = int(os.environ.get('DIFFDUB_MAX_JOBS', 2))
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+
+# Jobs waiting or running beyond this are turned away with a 503 instead of piling up
+MAX_PENDING_JOBS = int(os.environ.get('DIFFDUB_MAX_PENDING', 16))
+# Finished jobs that are never fetched are dropped after this many seconds
+JOB_TTL = int(os.environ.get('DIFFDUB_JOB_TTL', 3600))
+
+# Denoising dominates latency; plan tiers pick a preset, callers can also pass denoising_step directly
+DENOISING_PRESETS = {"fast": 5, "standard": 10, "high": 20}
+DEFAULT_DENOISING_STEP = 20
+MAX_DENOISING_STEP = 50
+
+# Streaming mode renders the script in windows of this many seconds and sends each as it finishes
+STREAM_WINDOW_SECONDS = int(os.environ.get('DIFFDUB_STREAM_WINDOW', 2))
+
+jobs = {}
+jobs_lock = threading.Lock()
+
+# Optional clip used to run one full generation at startup
+WARMUP_VIDEO = os.environ.get('DIFFDUB_WARMUP_VIDEO')
+WARMUP_AUDIO = os.environ.get('DIFFDUB_WARMUP_AUDIO')
+
+hubert_model = None
+hubert_feature_extractor = None
+
+
+def run_hubert(wav):
+    input_values = hubert_feature_extractor(wav.numpy(), sampling_rate=16000, padding=True, do_normalize=True, return_tensors="pt").input_values
+    with torch.no_grad():
+        outputs = hubert_model(input_values.to(DEVICE), output_hidden_states=True)
+        ws_feat_obj = torch.stack(outputs.hidden_states).squeeze(1).cpu().numpy()
+    # Pad one frame so the features line up with the 25fps video frames
+    return np.pad(ws_feat_obj, ((0, 0), (0, 1), (0, 0)), 'edge')
+
+
+def load_models():
+    global hubert_model, hubert_feature_extractor
+
+    print("🚀Loading HuBERT...")
+    with startup_stage("hubert"):
+        hubert_model = HubertModel.from_pretrained(HUBERT_MODEL_PATH).to(DEVICE).eval()
+        hubert_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(HUBERT_MODEL_PATH)
+
+    # demo_pipeline loads the diffusion checkpoints on every call; reading them once
+    # here keeps them in the page cache so those loads do not go to disk
+    with startup_stage("diffusion_checkpoints"):
+        for checkpoint in (STAGE1_CHECKPOINT, STAGE2_CHECKPOINT):
+            with open(checkpoint, 'rb') as f:
+                while f.read(1 << 24):
+                    pass
+
+
+def warmup():
+    with startup_stage("hubert_warmup"):
+        run_hubert(torch.zeros(16000))
+
+    if WARMUP_VIDEO and WARMUP_AUDIO:
+        with startup_stage("pipeline_warmup"):
+            with open(WARMUP_AUDIO, 'rb') as f:
+                hubert_features = extract_hubert_features(f.read())
+            warmup_dir = os.path.join(OUTPUTS, "warmup")
+            os.makedirs(warmup_dir, exist_ok=True)
+            render(hubert_features, WARMUP_AUDIO, WARMUP_VIDEO, warmup_dir, "warmup.mp4", denoising_step=1)
+            shutil.rmtree(warmup_dir, ignore_errors=True)
+
+
+def startup():
+    load_models()
+    warmup()
+
+
+QUEUE_DEPTH = Gauge("queue_depth", "Jobs waiting for a worker slot", namespace="diffdub")
+QUEUE_DEPTH.set_function(lambda: sum(1 for job in list(jobs.values()) if job["status"] == "queued"))
+JOBS_RUNNING = Gauge("jobs_running", "Jobs currently generating", namespace="diffdub")
+JOBS_RUNNING.set_function(lambda: sum(1 for job in list(jobs.values()) if job["status"] == "running"))
+
+
+def extract_hubert_features(audio_bytes):
+    wav, sr = torchaudio.load(io.BytesIO(audio_bytes))
+    wav = wav.mean(dim=0) if wav.shape[0] > 1 else wav[0]
+    if sr != 16000:
+        wav = torchaudio.functional.resample(wav, orig_freq=sr, new_freq=16000)
+    with STAGE_SECONDS.labels("hubert_extraction").time():
+        return run_hubert(wav)
+
+
+def as_npy_buffer(array):
+    # demo_pipeline np.load()s its features, which accepts a file object as well as a path
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    buffer.seek(0)
+    return buffer
+
+
+def update_job(job_id, **fields):
+    with jobs_lock:
+        if job_id in jobs:
+            jobs[job_id].update(fields)
+
+
+def job_cancelled(job_id):
+    with jobs_lock:
+        return jobs.get(job_id, {}).get("cancelled", False)
+
+
+def prepare_job(job_id, video_path, audio_bytes):
+    # demo_pipeline decodes and preprocesses the uploaded reference itself
+    print("🚀Features Generating...")
+    update_job(job_id, status="running", stage="feature_extraction", progress=0.05)
+    hubert_features = extract_hubert_features(audio_bytes)
+    return video_path, hubert_features
+
+
+def render(hubert_features, wav_path, reference_path, saved_path, saved_name, denoising_step=DEFAULT_DENOISING_STEP):
+    with STAGE_SECONDS.labels("denoising").time():
+        demo_pipeline(
+            one_shot=False,
+            video_inference=True,
+            stage1_checkpoint_path=STAGE1_CHECKPOINT,
+            stage2_checkpoint_path=STAGE2_CHECKPOINT,
+            saved_path=saved_path,
+            hubert_feat_path=as_npy_buffer(hubert_features),
+            wav_path=wav_path,
+            mp4_original_path=reference_path,
+            denoising_step=denoising_step,
+            reference_image_path="assets/single_images/test001.png",
+            saved_name=saved_name,
+            device=DEVICE
+        )
+    return os.path.join(saved_path, saved_name)
+
+
+def run_job(job_id, video_path, audio_path, audio_bytes, denoising_step):
+    reference_path, hubert_features = prepare_job(job_id, video_path, audio_bytes)
+
+    print("🚀Video Generating...")
+    update_job(job_id, stage="denoising", progress=0.2)
+    return render(hubert_features, audio_path, reference_path, OUTPUTS, f"{job_id}.mp4", denoising_step)
+
+
+def media_duration(path):
+    return float(subprocess.run([
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path
+    ], check=True, capture_output=True, text=True).stdout)
+
+
+def cut_reference(reference_path, reference_duration, start, duration, window_path):
+    # The reference is looped so windows past its end still get frames. -ss before -i seeks the input
+    # instead of decoding from t=0 for every window; the offset is wrapped into the first loop.
+    # Windows are cut at REFERENCE_FPS so their frame count matches the audio slice.
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-stream_loop', '-1', '-ss', f"{start % reference_duration:.3f}", '-i', reference_path,
+        '-t', f"{duration:.3f}",
+        '-r', str(REFERENCE_FPS), '-an', '-c:v', 'libx264', '-crf', '18', '-pix_fmt', 'yuv420p',
+        window_path
+    ], check=True, capture_output=True)
+
+
+def to_mpegts(video_path, offset):
+    # Timestamps are shifted so the segments play back to back as one stream
+    return subprocess.run([
+        'ffmpeg', '-loglevel', 'error',
+        '-i', video_path,
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac',
+        '-output_ts_offset', f"{offset:.3f}",
+        '-f', 'mpegts', 'pipe:1'
+    ], check=True, capture_output=True).stdout
+
+
+def run_stream_job(job_id, video_path, audio_bytes, denoising_step, segments):
+    job_dir = os.path.join(REQUESTS, job_id)
+    reference_path, hubert_features = prepare_job(job_id, video_path, audio_bytes)
+
+    wav, sr = torchaudio.load(io.BytesIO(audio_bytes))
+    reference_duration = media_duration(reference_path)
+    total_frames = math.ceil(wav.shape[1] * REFERENCE_FPS / sr)
+    window_frames = STREAM_WINDOW_SECONDS * REFERENCE_FPS
+    starts = list(range(0, total_frames, window_frames))
+
+    for index, first in enumerate(starts):
+        if job_cancelled(job_id):
+            print(f"🛑Stream {job_id} closed by client")
+            return
+        last = min(first + window_frames, total_frames)
+        update_job(job_id, stage="denoising", progress=0.2 + 0.8 * index / len(starts),
+                   window=index + 1, windows=len(starts))
+
+        window_dir = os.path.join(job_dir, f"window_{index:04d}")
+        os.makedirs(window_dir, exist_ok=True)
+
+        wav_path = os.path.join(window_dir, "audio.wav")
+        torchaudio.save(wav_path, wav[:, first * sr // REFERENCE_FPS:last * sr // REFERENCE_FPS], sr)
+        window_reference = os.path.join(window_dir, "reference.mp4")
+        with STAGE_SECONDS.labels("ffmpeg_mux").time():
+            cut_reference(reference_path, reference_duration, first / REFERENCE_FPS, (last - first) / REFERENCE_FPS, window_reference)
+
+        # Features come from the whole clip for context; two HuBERT frames per video frame plus the alignment pad
+        window_features = hubert_features[:, 2 * first:2 * last + 1]
+        window_video = render(window_features, wav_path, window_reference, window_dir, "window.mp4", denoising_step)
+
+        with STAGE_SECONDS.labels("ffmpeg_mux").time():
+            segment = to_mpegts(window_video, first / REFERENCE_FPS)
+        segments.put(segment)
+        shutil.rmtree(window_dir, ignore_errors=True)
+        print(f"📦Window {index + 1}/{len(starts)} sent ({job_id})")
+
+
+def process_stream_job(job_id, video_path, audio_bytes, denoising_step, segments):
+    # Streamed jobs are never fetched through /jobs, so the worker releases them itself
+    try:
+        run_stream_job(job_id, video_path, audio_bytes, denoising_step, segments)
+        print(f"✅Video Streamed ({job_id})")
+    except Exception as e:
+        print(f"❌Job {job_id} failed: {e}")
+        segments.put(e)
+    finally:
+        segments.put(None)
+        forget_job(job_id)
+
+
+def stream_segments(job_id, segments):
+    try:
+        while True:
+            segment = segments.get()
+            if segment is None:
+                break
+            if isinstance(segment, Exception):
+                # Raising aborts the chunked response, so the client sees a broken stream
+                # instead of a cleanly terminated, truncated video
+                print(f"❌Stream {job_id} aborted: {segment}")
+                raise segment
+            BYTES_OUT.inc(len(segment))
+            yield segment
+    finally:
+        update_job(job_id, cancelled=True)
+
+
+def process_job(job_id, video_path, audio_path, audio_bytes, denoising_step):
+    try:
+        generated_video_path = run_job(job_id, video_path, audio_path, audio_bytes, denoising_step)
+        if not os.path.exists(generated_video_path):
+            raise RuntimeError("Failed to generate video")
+        update_job(job_id, status="done", stage="done", progress=1.0, finished_at=time.time())
+        print(f"✅Video Generated ({job_id})")
+        return generated_video_path
+    except Exception as e:
+        update_job(job_id, status="failed", error=str(e), finished_at=time.time())
+        cleanup_job(job_id)
+        print(f"❌Job {job_id} failed: {e}")
+        raise
+
+
+def cleanup_job(job_id):
+    shutil.rmtree(os.path.join(REQUESTS, job_id), ignore_errors=True)
+    output_path = os.path.join(OUTPUTS, f"{job_id}.mp4")
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+
+def forget_job(job_id):
+    with jobs_lock:
+        jobs.pop(job_id, None)
+    cleanup_job(job_id)
+
+
+def reap_expired_jobs():
+    now = time.time()
+    with jobs_lock:
+        expired = [job_id for job_id, job in jobs.items()
+                   if job.get("finished_at") and now - job["finished_at"] > JOB_TTL]
+    for job_id in expired:
+        forget_job(job_id)
+
+
+def submit_job(reference_video, reference_audio, denoising_step, segments=None):
+    reap_expired_jobs()
+
+    job_id = uuid.uuid4().hex
+    with jobs_lock:
+        pending = sum(1 for job in jobs.values() if job["status"] in ("queued", "running"))
+        if pending >= MAX_PENDING_JOBS:
+            return None, None
+        jobs[job_id] = {
+            "job_id": job_id,
+            "status": "queued",
+            "stage": "queued",
+            "progress": 0.0,
+            "error": None,
+            "denoising_steps": denoising_step,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+
+    # Every job works in its own directory so overlapping jobs never share files
+    job_dir = os.path.join(REQUESTS, job_id)
+    video_path = os.path.join(job_dir, "UserVideo.mp4")
+    audio_path = os.path.join(job_dir, "UserAudio.wav")
+
+    # The waveform is kept in memory for HuBERT, the file is only for muxing the final video
+    try:
+        with STAGE_SECONDS.labels("upload_save").time():
+            os.makedirs(job_dir, exist_ok=True)
+            audio_bytes = reference_audio.read()
+            reference_video.save(video_path)
+            with open(audio_path, 'wb') as f:
+                f.write(audio_bytes)
+    except Exception:
+        # A queued entry that never reaches a worker would count against MAX_PENDING_JOBS forever
+        forget_job(job_id)
+        raise
+    print(f"🚀Assests Recived And Saved ({job_id})...")
+
+    if segments is not None:
+        return job_id, executor.submit(process_stream_job, job_id, video_path, audio_bytes, denoising_step, segments)
+    return job_id, executor.submit(process_job, job_id, video_path, audio_path, audio_bytes, denoising_step)
+
+
+def parse_denoising_step(values):
+    if 'quality' in values:
+        if values['quality'] not in DENOISING_PRESETS:
+            raise ValueError(f"quality must be one of {', '.join(DENOISING_PRESETS)}")
+        return DENOISING_PRESETS[values['quality']]
+
+    try:
+        denoising_step = int(values.get('denoising_step', DEFAULT_DENOISING_STEP))
+    except ValueError:
+        raise ValueError("denoising_step must be an integer")
+    if not 1 <= denoising_step <= MAX_DENOISING_STEP:
+        raise ValueError(f"denoising_step must be between 1 and {MAX_DENOISING_STEP}")
+    return denoising_step
+
+
+def busy_response():
+    response = jsonify({"error": "Server is busy, retry later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "30"
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+
+    if 'reference_video' not in request.files or 'reference_audio' not in request.files:
+        return jsonify({"error": "Missing reference_video or reference_audio"}), 400
+
+    try:
+        denoising_step = parse_denoising_step(request.values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    job_id, _ = submit_job(request.files['reference_video'], request.files['reference_audio'], denoising_step)
+    if job_id is None:
+        return busy_response()
+
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    with jobs_lock:
+        job = dict(jobs[job_id]) if job_id in jobs else None
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    with jobs_lock:
+        job = dict(jobs[job_id]) if job_id in jobs else None
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    if job["status"] != "done":
+        return jsonify({"error": "Job is not finished", "status": job["status"]}), 409
+
+    response = send_file(
+        os.path.join(OUTPUTS, f"{job_id}.mp4"),
+        mimetype="video/mp4",
+        as_attachment=True,
+        download_name="final_video.mp4"
+    )
+    response.call_on_close(lambda: forget_job(job_id))
+    return response
 
 
 @app.route('/generate_video', methods=['POST'])
@@ -21,56 +439,46 @@ def generate_video():
 
     if 'reference_video' not in request.files or 'reference_audio' not in request.files:
         return jsonify({"error": "Missing reference_video or reference_audio"}), 400
-    
-    reference_video = request.files['reference_video']
-    reference_audio = request.files['reference_audio']
-      
-    video_path = os.path.join(REQUESTS, "UserVideo.mp4")
-    audio_path = os.path.join(REQUESTS, "UserAudio.wav")
 
-    reference_video.save(video_path)
-    reference_audio.save(audio_path)
-    print("🚀Assests Recived And Saved...")
+    try:
+        denoising_step = parse_denoising_step(request.values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if request.values.get('stream') in ('1', 'true'):
+        # MPEG-TS segments can be concatenated, so each window is written out as soon as it is ready
+        segments = queue.Queue()
+        job_id, _ = submit_job(request.files['reference_video'], request.files['reference_audio'], denoising_step, segments)
+        if job_id is None:
+            return busy_response()
+        return Response(stream_segments(job_id, segments), mimetype="video/mp2t")
 
+    job_id, future = submit_job(request.files['reference_video'], request.files['reference_audio'], denoising_step)
+    if job_id is None:
+        return busy_response()
 
     try:
-        print("🚀Features Generating...")
-        extract_audio_features()
-    
-        print("🚀Video Generating...")
-        demo_pipeline(
-            one_shot=False,
-            video_inference=True,
-            stage1_checkpoint_path="assets/checkpoints/stage1_state_dict.ckpt",
-            stage2_checkpoint_path="assets/checkpoints/stage2_state_dict.ckpt",
-            saved_path=OUTPUTS,
-            hubert_feat_path="Requests/hubert_features.npy",
-            wav_path=audio_path,
-            mp4_original_path=video_path,
-            denoising_step=20,
-            reference_image_path="assets/single_images/test001.png",
-            saved_name="GeneratedVideo.mp4",
-            device="cuda:0"
+        generated_video_path = future.result()
+        response = send_file(
+            generated_video_path,
+            mimetype="video/mp4",
+            as_attachment=True,
+            download_name="final_video.mp4"
         )
-        generated_video_path = os.path.join(OUTPUTS, "GeneratedVideo.mp4")
-
-        if os.path.exists(generated_video_path):
-            return send_file(
-                generated_video_path,
-                mimetype="video/mp4",
-                as_attachment=True,
-                download_name="final_video.mp4"
-            )
-        else:
-            return jsonify({"error": "Failed to generate video"}), 500
+        response.call_on_close(lambda: forget_job(job_id))
+        return response
     except Exception as e:
+        forget_job(job_id)
         return jsonify({"error": str(e)}), 500
 
+# Models load in the background so /healthz answers while they warm up
+service.start(startup)
+
 if __name__ == '__main__':
-  
+
     print("🚀Starting ngrok...")
     ngrok.set_auth_token("YOUR_AUTH_TOKEN")
     public_url = ngrok.connect(5000).public_url
     print(f"Public URL: {public_url}")
 
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -0,0 +1,104 @@
+import argparse
+import csv
+import os
+import shutil
+import time
+import cv2
+import numpy as np
+import torchaudio
+
+
+def read_mouth_frames(video_path):
+    # Lower-centre crop of every frame, where the regenerated mouth sits in a cropped talking face
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        h, w = frame.shape[:2]
+        frames.append(cv2.cvtColor(frame[h // 2:, w // 4:3 * w // 4], cv2.COLOR_BGR2GRAY).astype(np.float32))
+    capture.release()
+    return np.stack(frames)
+
+
+def psnr(frames, reference):
+    n = min(len(frames), len(reference))
+    mse = np.mean((frames[:n] - reference[:n]) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def sync_score(frames, audio_path, fps):
+    # Correlation between mouth motion and loudness per video frame, a cheap stand-in for a SyncNet score
+    wav, sr = torchaudio.load(audio_path)
+    wav = wav.mean(dim=0).numpy()
+    hop = int(sr / fps)
+    rms = np.array([np.sqrt(np.mean(wav[i * hop:(i + 1) * hop] ** 2)) for i in range(len(frames))])
+    motion = np.concatenate([[0.0], np.mean(np.abs(np.diff(frames, axis=0)), axis=(1, 2))])
+    if motion.std() == 0 or rms.std() == 0:
+        return 0.0
+    return float(np.corrcoef(motion, rms)[0, 1])
+
+
+def main(args):
+    os.environ['DIFFDUB_DEVICE'] = args.device
+    # Imported late so the device is picked up when the server module loads its models
+    import app as server
+    while not server.service.ready.wait(1):
+        if server.service.startup_error:
+            raise SystemExit(f"Model loading failed: {server.service.startup_error}")
+    extract_hubert_features, render = server.extract_hubert_features, server.render
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(args.audio, 'rb') as f:
+        hubert_features = extract_hubert_features(f.read())
+
+    results = {}
+    for steps in sorted(args.steps, reverse=True):
+        timings = []
+        for repeat in range(args.repeats):
+            start = time.perf_counter()
+            video_path = render(hubert_features, args.audio, args.video, args.output_dir, f"steps_{steps}.mp4", steps)
+            timings.append(time.perf_counter() - start)
+            print(f"⏱️{steps} steps, run {repeat + 1}/{args.repeats}: {timings[-1]:.1f}s")
+        results[steps] = (video_path, timings)
+
+    # The highest step count is the quality reference the faster schedules are compared against
+    reference_frames = read_mouth_frames(results[max(results)][0])
+    rows = []
+    for steps in sorted(results):
+        video_path, timings = results[steps]
+        frames = read_mouth_frames(video_path)
+        rows.append({
+            "denoising_step": steps,
+            "latency_s": round(float(np.median(timings)), 2),
+            "psnr_vs_max_steps": round(psnr(frames, reference_frames), 2),
+            "sync_score": round(sync_score(frames, args.audio, server.REFERENCE_FPS), 3),
+        })
+
+    print(f"{'steps':>6} {'latency_s':>10} {'psnr':>8} {'sync':>7}")
+    for row in rows:
+        print(f"{row['denoising_step']:>6} {row['latency_s']:>10} {row['psnr_vs_max_steps']:>8} {row['sync_score']:>7}")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    if not args.keep_outputs:
+        shutil.rmtree(args.output_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency vs. quality of Diffdub for different denoising step counts.")
+    parser.add_argument("--video", type=str, default='assets/samples/reference.mp4', help="Reference video (25 fps).")
+    parser.add_argument("--audio", type=str, default='assets/samples/audio.wav', help="Driving audio.")
+    parser.add_argument("--steps", type=int, nargs='+', default=[5, 10, 20], help="Denoising step counts to compare.")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per step count; the median latency is reported.")
+    parser.add_argument("--device", type=str, default='cpu', help="Device to benchmark on.")
+    parser.add_argument("--output_dir", type=str, default='Outputs/benchmark', help="Where the rendered clips are written.")
+    parser.add_argument("--csv", type=str, default=None, help="Optional CSV file for the results.")
+    parser.add_argument("--keep_outputs", action='store_true', help="Keep the rendered clips for visual inspection.")
+    args = parser.parse_args()
+    main(args)
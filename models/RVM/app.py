@@ -1,11 +1,67 @@
+import os
+import sys
+# Shared service code lives in models/common; AVATAR_LAB_MODELS points at the models/ directory
+# when app.py runs from inside a model checkout
+MODELS_DIR = os.environ.get('AVATAR_LAB_MODELS', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# Appended, not prepended, so it never shadows the model checkout's own modules
+if os.path.isdir(os.path.join(MODELS_DIR, 'common')):
+    sys.path.append(MODELS_DIR)
 from flask import Flask, request, jsonify, send_file
+from prometheus_client import Histogram
 from pyngrok import ngrok
-import os
+from matting import MattingEngine
+from background_cache import BackgroundCache
+from common.model_service import ModelService
 import subprocess
 import uuid
-import time
 
-app = Flask(_name_)
+app = Flask(__name__)
+# The landing page answers while the model is still loading
+service = ModelService(app, "rvm", public_endpoints=("home",))
+startup_stage = service.startup_stage
+STAGE_SECONDS = service.stage_seconds
+
+BASE_DIR = os.path.abspath(os.getcwd())
+CHECKPOINT_PATH = os.path.join(BASE_DIR, 'weights/rvm_mobilenetv3.pth')
+# The options inference.py used to be launched with
+VARIANT = os.environ.get('RVM_VARIANT', 'mobilenetv3')
+DEVICE = os.environ.get('RVM_DEVICE', 'cpu')
+INPUT_RESIZE = (584, 584)
+# Pipeline tuning: torch intra-op threads for the model stage, ffmpeg threads for decode and encode
+# (0 lets ffmpeg choose), frames per model call (0 picks it from the resolution) and the number of
+# those chunks buffered between stages
+SEQ_CHUNK = int(os.environ.get('RVM_SEQ_CHUNK', 0)) or None
+INTRA_OP_THREADS = int(os.environ.get('RVM_THREADS', 0)) or None
+DECODE_THREADS = int(os.environ.get('RVM_DECODE_THREADS', 2))
+ENCODE_THREADS = int(os.environ.get('RVM_ENCODE_THREADS', 2))
+QUEUE_SIZE = int(os.environ.get('RVM_QUEUE_SIZE', 2))
+
+engine = None
+# Backgrounds come from a small library, so decoded frames are kept per (content, resolution)
+background_cache = BackgroundCache(
+    os.path.join(BASE_DIR, 'Cache/backgrounds'),
+    device=DEVICE,
+    max_entries=int(os.environ.get('RVM_BACKGROUND_CACHE_SIZE', 32)),
+    max_bytes=int(os.environ.get('RVM_BACKGROUND_CACHE_MB', 4096)) * 1024 ** 2,
+)
+
+def startup():
+    global engine
+    with startup_stage("matting_model"):
+        engine = MattingEngine(
+            CHECKPOINT_PATH, variant=VARIANT, device=DEVICE, input_resize=INPUT_RESIZE,
+            seq_chunk=SEQ_CHUNK, intra_op_threads=INTRA_OP_THREADS, decode_threads=DECODE_THREADS,
+            encode_threads=ENCODE_THREADS, queue_size=QUEUE_SIZE,
+        )
+    # One dummy chunk so allocator and kernel set-up are not paid by the first request
+    with startup_stage("warmup"):
+        engine.warmup()
+
+
+PIPELINE_UTILIZATION = Histogram("pipeline_stage_utilization", "Fraction of a job's wall time each pipeline stage was busy",
+                                 ["stage"], namespace="rvm", buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+PIPELINE_FPS = Histogram("pipeline_fps", "Frames per second of each matting job", namespace="rvm",
+                         buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120))
 
 @app.route('/custom_bg', methods=['POST'])
 def custom_bg():
@@ -23,88 +79,53 @@ def custom_bg():
             return jsonify({'error': 'Video file is required'}), 400
         
         video_path = os.path.join(uploads_dir, f"input_{uuid.uuid4().hex}.mp4")
-        video_file.save(video_path)
+        with STAGE_SECONDS.labels("upload_save").time():
+            video_file.save(video_path)
         
-        # Check if a custom background was provided
+        # Check if a custom background was provided (an image or a video)
         bg_file = request.files.get('bg')
+        bg_path = None
         if bg_file:
-            bg_path = os.path.join(uploads_dir, f"bg_{uuid.uuid4().hex}.png")
-            bg_file.save(bg_path)
+            bg_data = bg_file.read()
+            bg_name = bg_file.filename
         else:
             # Use absolute path for default background
             bg_path = os.path.join(base_dir, 'bg.png')  # default background in project folder
-        
-        # Verify background file exists
-        if not os.path.exists(bg_path):
-            return jsonify({'error': 'Background file not found'}), 400
+            if not os.path.exists(bg_path):
+                return jsonify({'error': 'Background file not found'}), 400
+            bg_name = bg_path
+        
+        try:
+            w, h = engine.frame_size(video_path)
+        except subprocess.CalledProcessError as e:
+            return jsonify({'error': 'Video could not be read', 'details': e.stderr or str(e)}), 400
+        
+        # Decoded and resized once per (content, resolution); later requests reuse the cached frames.
+        # The default background is only re-read and re-hashed when its file changes.
+        with STAGE_SECONDS.labels("background_load").time():
+            try:
+                if bg_path:
+                    background = background_cache.get_file(bg_path, w, h)
+                else:
+                    background = background_cache.get(bg_data, w, h)
+            except (ValueError, subprocess.CalledProcessError) as e:
+                return jsonify({'error': 'Background could not be decoded', 'details': str(e)}), 400
         
         # Output path with absolute path
-        temp_output_filename = f"temp_output_{uuid.uuid4().hex}.mp4"
-        temp_output_path = os.path.join(uploads_dir, temp_output_filename)
-        
         final_output_filename = f"output_{uuid.uuid4().hex}.mp4"
         final_output_path = os.path.join(uploads_dir, final_output_filename)
         
         print(f"Processing video: {video_path}")
-        print(f"Using background: {bg_path}")
-        print(f"Temporary output will be saved to: {temp_output_path}")
+        print(f"Using background: {bg_name}")
         print(f"Final output will be saved to: {final_output_path}")
         
-        # Run the inference command with absolute paths
-        command = [
-            'python', os.path.join(base_dir, 'inference.py'),
-            '--variant', 'mobilenetv3',
-            '--device', 'cpu',
-            '--checkpoint', os.path.join(base_dir, 'weights/rvm_mobilenetv3.pth'),
-            '--input-source', video_path,
-            '--background-source', bg_path,
-            '--input-resize', '584', '584',
-            '--output-composition', temp_output_path,
-            '--output-type', 'video'
-        ]
-        
-        print(f"Running command: {' '.join(command)}")
-        
-        # Run the subprocess
-        process = subprocess.run(command, check=True, capture_output=True, text=True)
-        print(f"Process stdout: {process.stdout}")
-        print(f"Process stderr: {process.stderr}")
-        
-        # Wait a moment to ensure file system has completed writing
-        time.sleep(1)
-        
-        # Verify the output file exists
-        if not os.path.exists(temp_output_path):
-            print(f"Output file not found at: {temp_output_path}")
-            
-            # Check if it's in a different location
-            for root, dirs, files in os.walk(base_dir):
-                if temp_output_filename in files:
-                    found_path = os.path.join(root, temp_output_filename)
-                    print(f"Found output file at: {found_path}")
-                    temp_output_path = found_path
-                    break
-            else:
-                return jsonify({'error': 'Output file not created'}), 500
-        
-        # Now copy the audio from the original video to the output
-        print(f"Copying audio from original video to output")
-        ffmpeg_command = [
-            'ffmpeg',
-            '-i', temp_output_path,  # Video without audio
-            '-i', video_path,        # Original video with audio
-            '-c:v', 'copy',          # Copy video stream without re-encoding
-            '-c:a', 'aac',           # Use AAC codec for audio
-            '-map', '0:v:0',         # Use video from first input
-            '-map', '1:a:0',         # Use audio from second input
-            '-shortest',             # End when shortest input ends
-            final_output_path
-        ]
-        
-        print(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
-        ffmpeg_process = subprocess.run(ffmpeg_command, check=True, capture_output=True, text=True)
-        print(f"FFmpeg stdout: {ffmpeg_process.stdout}")
-        print(f"FFmpeg stderr: {ffmpeg_process.stderr}")
+        # Decode, matting, compositing, encoding and the audio mux all happen in one pass
+        with STAGE_SECONDS.labels("matting_pipeline").time():
+            stats = engine.render(video_path, background, final_output_path)
+        print(f"Pipeline stats: {stats}")
+        PIPELINE_FPS.observe(stats["fps"])
+        for stage, utilization in stats["utilization"].items():
+            PIPELINE_UTILIZATION.labels(stage).observe(utilization)
         
         # Check if the final output file exists
         if not os.path.exists(final_output_path):
@@ -146,7 +167,10 @@ def process_video():
 def home():
     return "Video Background Replacement API is running. Use POST /custom_bg to process videos."
 
-if _name_ == '_main_':
+# Startup runs in the background so /healthz answers straight away
+service.start(startup)
+
+if __name__ == '__main__':
     print("Starting ngrok...")
     ngrok.set_auth_token("YOUR_AUTH_TOKEN")
     public_url = ngrok.connect(8000).public_url
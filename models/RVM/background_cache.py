@@ -0,0 +1,151 @@
+import io
+import os
+import shutil
+import hashlib
+import threading
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+
+class BackgroundCache:
+    # Decoded backgrounds keyed by the SHA-256 of the file and the output resolution.
+    # Images are kept as ready-to-composite (1, 3, H, W) float tensors in an in-memory LRU.
+    # Videos are decoded once into a raw (N, H, W, 3) uint8 frame store on disk, memory-mapped afresh
+    # for each request; stores are evicted by total size with directory mtimes as the LRU order.
+
+    def __init__(self, root, device='cpu', max_entries=32, max_bytes=4 * 1024 ** 3):
+        self.root = root
+        self.device = torch.device(device)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.file_digests = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def get(self, data, w, h):
+        # Returns a (1, 3, h, w) tensor for images or an (N, h, w, 3) memmap for videos
+        return self.lookup(hashlib.sha256(data).hexdigest(), w, h, lambda: data)
+
+    def get_file(self, path, w, h):
+        # Same as get() for a file on disk. Its digest is remembered per (path, mtime), so a file
+        # served on every request (the default background) is only read and hashed when it changes.
+        file_key = (path, os.stat(path).st_mtime_ns)
+        with self.lock:
+            digest = self.file_digests.get(file_key)
+        if digest is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            with self.lock:
+                self.file_digests[file_key] = digest
+            return self.lookup(digest, w, h, lambda: data)
+
+        def load():
+            with open(path, 'rb') as f:
+                return f.read()
+        return self.lookup(digest, w, h, load)
+
+    def lookup(self, digest, w, h, load):
+        # load() returns the file's bytes; it is only called when nothing is cached for the key
+        key = (digest, w, h)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            frames = self.open_store(key)
+        if frames is not None:
+            return frames
+
+        data = load()
+        try:
+            background = self.decode_image(data, w, h)
+        except Image.UnidentifiedImageError:
+            return self.frame_store(key, data)
+
+        with self.lock:
+            self.entries[key] = background
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return background
+
+    def decode_image(self, data, w, h):
+        image = Image.open(io.BytesIO(data)).convert('RGB').resize((w, h))
+        return transforms.ToTensor()(image).to(self.device).unsqueeze(0)
+
+    def store_dir(self, key):
+        digest, w, h = key
+        return os.path.join(self.root, f"{digest}_{w}x{h}")
+
+    def open_store(self, key):
+        # Called with the lock held, so evict() cannot remove the store between the check and the map.
+        # Every hit refreshes the mtime, which is what keeps frequently used stores from being evicted.
+        store_dir = self.store_dir(key)
+        frames_path = os.path.join(store_dir, "frames.rgb")
+        if not os.path.exists(frames_path):
+            return None
+        os.utime(store_dir)
+        _, w, h = key
+        return np.memmap(frames_path, dtype=np.uint8, mode='r').reshape(-1, h, w, 3)
+
+    def frame_store(self, key, data):
+        store_dir = self.store_dir(key)
+        # A store built here can still be evicted by a concurrent request before it is mapped;
+        # it is then rebuilt once more
+        for _ in range(2):
+            self.build(key, data)
+            self.evict(keep=store_dir)
+            with self.lock:
+                frames = self.open_store(key)
+            if frames is not None:
+                return frames
+        raise RuntimeError("Background frame store was evicted before it could be used")
+
+    def build(self, key, data):
+        _, w, h = key
+        store_dir = self.store_dir(key)
+        tmp_dir = f"{store_dir}.tmp_{threading.get_ident()}"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            # ffmpeg reads the upload from stdin and writes frames already scaled to the output size
+            subprocess.run([
+                'ffmpeg', '-y', '-loglevel', 'error', '-i', '-',
+                '-vf', f'scale={w}:{h}', '-an', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                os.path.join(tmp_dir, "frames.rgb")
+            ], input=data, check=True, capture_output=True)
+            if os.path.getsize(os.path.join(tmp_dir, "frames.rgb")) == 0:
+                raise ValueError("Background is neither an image nor a decodable video")
+
+            with self.lock:
+                if os.path.exists(os.path.join(store_dir, "frames.rgb")):
+                    # Another request built the same background meanwhile
+                    return
+                os.rename(tmp_dir, store_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def evict(self, keep=None):
+        with self.lock:
+            stores = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                if '.tmp_' in name or not os.path.isdir(path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                stores.append((os.path.getmtime(path), path, size))
+
+            total = sum(size for _, _, size in stores)
+            for _, path, size in sorted(stores):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                # Stores mapped by a running render keep working; their space is freed when it finishes
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                print(f"🧹Evicted background {os.path.basename(path)[:12]} ({size / 1e6:.1f} MB)")
@@ -0,0 +1,246 @@
+import json
+import time
+import queue
+import threading
+import tempfile
+import subprocess
+import numpy as np
+import torch
+from model import MattingNetwork
+
+
+def auto_downsample_ratio(h, w):
+    # Same rule as inference.py: run the base network at roughly 512px on the long side
+    return min(512 / max(h, w), 1)
+
+
+# Frames per model call are chosen so one chunk holds about this many pixels: 24 frames at 584x584,
+# 4 at 1080p. Bounded to 1..MAX_SEQ_CHUNK.
+SEQ_CHUNK_PIXELS = 32 * 512 * 512
+MAX_SEQ_CHUNK = 32
+
+
+def auto_seq_chunk(h, w):
+    return max(1, min(MAX_SEQ_CHUNK, SEQ_CHUNK_PIXELS // (h * w)))
+
+
+def probe(path):
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,avg_frame_rate', '-of', 'json', path
+    ], check=True, capture_output=True, text=True)
+    stream = json.loads(result.stdout)['streams'][0]
+    num, den = stream['avg_frame_rate'].split('/')
+    return stream['width'], stream['height'], float(num) / float(den or 1)
+
+
+def decode_frames(path, w, h, threads=0):
+    # Raw RGB frames straight from ffmpeg, scaled to the size the network runs at. stderr goes to a
+    # temporary file so a chatty decoder cannot fill the pipe while frames are being read.
+    errors = tempfile.TemporaryFile()
+    decoder = subprocess.Popen([
+        'ffmpeg', '-loglevel', 'error', '-threads', str(threads), '-i', path,
+        '-vf', f'scale={w}:{h}', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'
+    ], stdout=subprocess.PIPE, stderr=errors)
+    frame_size = w * h * 3
+    try:
+        while True:
+            # A fresh writable buffer per frame, so it can back a tensor without a copy
+            data = bytearray(frame_size)
+            if decoder.stdout.readinto(data) < frame_size:
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+        # Only checked once the output is exhausted; a consumer that stops early kills the pipe itself
+        if decoder.wait() != 0:
+            errors.seek(0)
+            raise RuntimeError(f"ffmpeg decoding failed: {errors.read().decode(errors='replace')}")
+    finally:
+        decoder.stdout.close()
+        decoder.wait()
+        errors.close()
+
+
+def open_encoder(output_path, w, h, fps, audio_source, output_video_mbps, threads=0):
+    # Composited frames come in on stdin; the source's audio track, if any, is muxed in the same pass
+    return subprocess.Popen([
+        'ffmpeg', '-y', '-loglevel', 'error', '-threads', str(threads),
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-r', f'{fps}', '-i', '-',
+        '-i', audio_source,
+        '-map', '0:v:0', '-map', '1:a:0?',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-b:v', f'{output_video_mbps}M',
+        '-c:a', 'aac', '-shortest', '-threads', str(threads),
+        output_path
+    ], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def put(q, item, stop):
+    # Blocking put that gives up once another stage has failed, so no thread waits forever
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+class MattingEngine:
+    # In-process replacement for `python inference.py`. The network and checkpoint are loaded once,
+    # and render() produces the composited video the service returns; inference.py's other output
+    # types (alpha, foreground, png sequences) are not used by the service and not provided.
+
+    def __init__(self, checkpoint, variant='mobilenetv3', device='cpu', input_resize=None, downsample_ratio=None,
+                 seq_chunk=None, intra_op_threads=None, decode_threads=0, encode_threads=0, queue_size=2):
+        self.device = torch.device(device)
+        self.input_resize = input_resize
+        # None picks both from the frame size; see auto_downsample_ratio and auto_seq_chunk
+        self.downsample_ratio = downsample_ratio
+        self.seq_chunk = seq_chunk
+        # Decode and encode run in ffmpeg (0 lets it choose), so torch only needs the cores left for the model
+        self.decode_threads = decode_threads
+        self.encode_threads = encode_threads
+        self.queue_size = queue_size
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        self.model = MattingNetwork(variant).eval().to(self.device)
+        self.model.load_state_dict(torch.load(checkpoint, map_location=self.device))
+
+    @torch.no_grad()
+    def warmup(self):
+        h, w = self.input_resize[::-1] if self.input_resize else (512, 512)
+        src = torch.zeros(1, self.seq_chunk or auto_seq_chunk(h, w), 3, h, w, device=self.device)
+        self.model(src, *[None] * 4, self.downsample_ratio or auto_downsample_ratio(h, w))
+
+    def frame_size(self, input_source):
+        # (w, h) the network and the composite run at, which is what backgrounds must be decoded to
+        if self.input_resize:
+            return self.input_resize
+        src_w, src_h, _ = probe(input_source)
+        return src_w, src_h
+
+    @torch.no_grad()
+    def render(self, input_source, background, output_path, output_video_mbps=4):
+        # Single pass: ffmpeg decode -> matting with the recurrent state carried across frames ->
+        # composite -> ffmpeg encode with the original audio. Nothing intermediate touches disk.
+        # Decode and encode each run on their own thread, connected to the model by bounded queues,
+        # so frame conversion and pipe I/O overlap inference. Frames go through the model seq_chunk at
+        # a time along its time dimension, with the recurrent state carried from chunk to chunk.
+        # `background` comes from BackgroundCache at frame_size(): a (1, 3, H, W) image tensor, or an
+        # (N, H, W, 3) uint8 frame store for video backgrounds, which loop if shorter than the input.
+        # Returns per-stage utilization.
+        src_w, src_h, fps = probe(input_source)
+        w, h = self.input_resize if self.input_resize else (src_w, src_h)
+        downsample_ratio = self.downsample_ratio or auto_downsample_ratio(h, w)
+        seq_chunk = self.seq_chunk or auto_seq_chunk(h, w)
+
+        decoded = queue.Queue(maxsize=self.queue_size)
+        composited = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        errors = []
+        busy = {"decode": 0.0, "infer": 0.0, "encode": 0.0}
+        encoder = open_encoder(output_path, w, h, fps, input_source, output_video_mbps, self.encode_threads)
+
+        def background_chunk(offset, length):
+            if isinstance(background, torch.Tensor):
+                return background
+            indices = np.arange(offset, offset + length) % len(background)
+            return torch.from_numpy(background[indices]).permute(0, 3, 1, 2).unsqueeze(0).float().div(255)
+
+        def decode_stage():
+            frames = decode_frames(input_source, w, h, self.decode_threads)
+            offset = 0
+            try:
+                done = False
+                while not done:
+                    start = time.perf_counter()
+                    chunk = []
+                    while len(chunk) < seq_chunk:
+                        frame = next(frames, None)
+                        if frame is None:
+                            done = True
+                            break
+                        chunk.append(torch.from_numpy(frame))
+                    if not chunk:
+                        break
+                    # (1, T, C, H, W): batch of one sequence of T frames
+                    src = torch.stack(chunk).permute(0, 3, 1, 2).unsqueeze(0).float().div(255)
+                    bgr = background_chunk(offset, len(chunk))
+                    offset += len(chunk)
+                    busy["decode"] += time.perf_counter() - start
+                    if not put(decoded, (src, bgr), stop):
+                        break
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                frames.close()
+                put(decoded, None, stop)
+
+        def encode_stage():
+            try:
+                while True:
+                    com = get(composited, stop)
+                    if com is None:
+                        break
+                    start = time.perf_counter()
+                    # All T frames of the chunk in one contiguous (T, H, W, C) buffer
+                    out = com[0].mul(255).round().clamp(0, 255).byte().permute(0, 2, 3, 1).contiguous().cpu().numpy()
+                    encoder.stdin.write(out.tobytes())
+                    busy["encode"] += time.perf_counter() - start
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        threads = [threading.Thread(target=decode_stage, daemon=True), threading.Thread(target=encode_stage, daemon=True)]
+        wall_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        frames = 0
+        rec = [None] * 4
+        try:
+            while True:
+                item = get(decoded, stop)
+                if item is None:
+                    break
+                src, bgr = item
+                start = time.perf_counter()
+                fgr, pha, *rec = self.model(src.to(self.device), *rec, downsample_ratio)
+                com = fgr * pha + bgr.to(self.device) * (1 - pha)
+                busy["infer"] += time.perf_counter() - start
+                frames += src.shape[1]
+                if not put(composited, com, stop):
+                    break
+        except Exception:
+            stop.set()
+            raise
+        finally:
+            put(composited, None, stop)
+            for thread in threads:
+                thread.join()
+            encoder.stdin.close()
+            stderr = encoder.stderr.read().decode()
+            encoder.wait()
+
+        if errors:
+            raise errors[0]
+        if encoder.returncode != 0:
+            raise RuntimeError(f"ffmpeg encoding failed: {stderr}")
+
+        wall = time.perf_counter() - wall_start
+        return {
+            "frames": frames,
+            "seq_chunk": seq_chunk,
+            "downsample_ratio": round(downsample_ratio, 3),
+            "fps": round(frames / wall, 2) if wall > 0 else 0.0,
+            "utilization": {stage: round(seconds / wall, 3) if wall > 0 else 0.0 for stage, seconds in busy.items()},
+        }
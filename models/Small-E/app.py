@@ -1,25 +1,232 @@
+import os
+import sys
+# Shared service code lives in models/common; AVATAR_LAB_MODELS points at the models/ directory
+# when app.py runs from inside a model checkout
+MODELS_DIR = os.environ.get("AVATAR_LAB_MODELS", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# Appended, not prepended, so it never shadows the model checkout's own modules
+if os.path.isdir(os.path.join(MODELS_DIR, "common")):
+    sys.path.append(MODELS_DIR)
 import torch
 from train_lina import TrainLina
 from decoder.pretrained import WavTokenizer
 from transformers import PreTrainedTokenizerFast
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, send_file, jsonify, stream_with_context
+from prometheus_client import Counter, Histogram
 from pyngrok import ngrok
 import soundfile as sf
 import torchaudio
-import tempfile
+import io
+import struct
+from prompt_cache import PromptCache
+from text_processing import TextTokenizer, normalize_text, split_sentences
+from common.model_service import ModelService
 import numpy as np
-import os
 
 app = Flask(__name__)
+service = ModelService(app, "smalle")
+startup_stage = service.startup_stage
+STAGE_SECONDS = service.stage_seconds
+
+model = None
+tokenizer = None
+text_tokenizer = None
+wavtokenizer = None
+bandwidth_id = None
+
+DEVICE = os.environ.get("SMALLE_DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
+# Dynamic int8 quantization of the Linear layers; PyTorch only provides these kernels on CPU
+QUANTIZE = os.environ.get("SMALLE_QUANTIZE", "0") in ("1", "true")
+if os.environ.get("SMALLE_NUM_THREADS"):
+    torch.set_num_threads(int(os.environ["SMALLE_NUM_THREADS"]))
+
+# Voices come from a small fixed set, so their encoded prompt tokens are kept between requests
+prompt_cache = PromptCache(
+    max_entries=int(os.environ.get("SMALLE_PROMPT_CACHE_SIZE", 64)),
+    persist_dir=os.environ.get("SMALLE_PROMPT_CACHE_DIR"),
+)
+
+# Best-of-N voice cloning: 1 is the lowest latency, more candidates trade compute for robustness
+DEFAULT_CANDIDATES = int(os.environ.get("SMALLE_CANDIDATES", 1))
+MAX_CANDIDATES = 8
+# WavTokenizer runs at 75 tokens/s on 24kHz audio
+SAMPLES_PER_TOKEN = 320
+
+# Generation length budget: text tokens x frames per token, with headroom, capped at the old fixed limits
+FRAMES_PER_TOKEN = float(os.environ.get("SMALLE_FRAMES_PER_TOKEN", 20))
+LENGTH_MARGIN = 1.5
+MIN_NEW_FRAMES = 75
+MAX_SEQLEN_TTS = 2000
+MAX_SEQLEN_VOICE = 4000
+
+# Streaming synthesis: tokens of the previous sentence re-decoded under the next one and crossfaded
+STREAM_OVERLAP_TOKENS = 8
+STREAM_FORMATS = {"wav": "audio/wav", "pcm": "audio/L16;rate=24000;channels=1"}
+
+
+def load_models():
+    global model, tokenizer, text_tokenizer, wavtokenizer, bandwidth_id
+
+    print("Loading models...")
+    with startup_stage("lina_model"):
+        model = TrainLina.load_from_checkpoint("check/last.ckpt").model.eval().to(DEVICE)
+    with startup_stage("bpe_tokenizer"):
+        tokenizer = PreTrainedTokenizerFast(tokenizer_file="bpe256.json")
+        text_tokenizer = TextTokenizer(tokenizer, max_entries=int(os.environ.get("SMALLE_TOKEN_CACHE_SIZE", 4096)))
+    with startup_stage("wavtokenizer"):
+        config_path = "check/wavtokenizer_mediumdata_frame75_3s_nq1_code4096_dim512_kmeans200_attn.yaml"
+        model_path = "check/wavtokenizer_medium_speech_320_24k.ckpt"
+        wavtokenizer = WavTokenizer.from_pretrained0802(config_path, model_path).to(DEVICE)
+    bandwidth_id = torch.tensor([0], device=DEVICE)
+    if QUANTIZE:
+        quantize_models()
+    print("Models loaded successfully.")
+
+
+def quantize_models():
+    # The autoregressive LinaModel (text encoder included) and the WavTokenizer decoder (backbone
+    # and head) dominate CPU time; the encoder only runs on prompt misses and stays fp32
+    global model
+    if DEVICE != "cpu":
+        print(f"⚠️ Int8 quantization is CPU-only, keeping fp32 on {DEVICE}")
+        return
+    with startup_stage("quantize"):
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        wavtokenizer.backbone = torch.ao.quantization.quantize_dynamic(wavtokenizer.backbone, {torch.nn.Linear}, dtype=torch.qint8)
+        wavtokenizer.head = torch.ao.quantization.quantize_dynamic(wavtokenizer.head, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def warmup():
+    # A short dummy synthesis triggers CUDA context, kernel and allocator initialisation
+    # so the first real request runs at steady-state latency
+    with startup_stage("warmup"):
+        txt = torch.LongTensor(text_tokenizer.encode("[BOS]Hello there.[EOS]")).to(DEVICE)
+        _, _, _, cuts = model.generate_batch(txt, batch_size=1, k=100, max_seqlen=100, device=DEVICE)
+        features = wavtokenizer.codes_to_features(cuts[0][0][..., :].to(DEVICE))
+        wavtokenizer.decode(features, bandwidth_id=bandwidth_id)
+        if DEVICE.startswith("cuda"):
+            torch.cuda.synchronize()
+
+
+def startup():
+    load_models()
+    warmup()
+
+
+PROMPT_CACHE_HITS = Counter("prompt_cache_hits", "Voice prompts served from the token cache", namespace="smalle")
+PROMPT_CACHE_MISSES = Counter("prompt_cache_misses", "Voice prompts that had to be encoded", namespace="smalle")
+
+# Observed audio frames per text token, for calibrating SMALLE_FRAMES_PER_TOKEN
+FRAMES_PER_TEXT_TOKEN = Histogram("frames_per_text_token", "Generated audio frames per input text token",
+                                  namespace="smalle", buckets=(2, 4, 6, 8, 10, 12, 15, 20, 25, 30, 40))
+
+# Output formats as (soundfile format, subtype, mimetype, extension)
+AUDIO_FORMATS = {
+    "wav": ("WAV", "PCM_16", "audio/wav", "wav"),
+    "flac": ("FLAC", "PCM_16", "audio/flac", "flac"),
+    "opus": ("OGG", "OPUS", "audio/ogg", "ogg"),
+}
+
+
+def negotiate_format():
+    # An explicit ?format= wins, otherwise the best match from the Accept header, falling back to WAV
+    if "format" in request.args:
+        fmt = request.args["format"].lower()
+        return fmt if fmt in AUDIO_FORMATS else None
+    mimetypes = {"audio/wav": "wav", "audio/x-wav": "wav", "audio/flac": "flac", "audio/ogg": "opus", "audio/opus": "opus"}
+    best = request.accept_mimetypes.best_match(list(mimetypes))
+    return mimetypes.get(best, "wav")
+
+
+def seqlen_budget(n_text_tokens, cap, prompt_len=0):
+    # An upper bound on audio frames for this text, so short sentences stop well before the cap
+    # even when a row never emits end-of-audio
+    new_frames = max(MIN_NEW_FRAMES, int(n_text_tokens * FRAMES_PER_TOKEN * LENGTH_MARGIN))
+    return min(cap, prompt_len + new_frames)
+
+
+def audio_response(audio_numpy, fmt):
+    sf_format, subtype, mimetype, extension = AUDIO_FORMATS[fmt]
+    buffer = io.BytesIO()
+    with STAGE_SECONDS.labels("encode").time():
+        sf.write(buffer, audio_numpy, 24000, format=sf_format, subtype=subtype)
+    buffer.seek(0)
+    return send_file(buffer, mimetype=mimetype, as_attachment=True, download_name=f"output.{extension}")
+
+
+def generate(txt, **kwargs):
+    # Requests generate on their own Flask threads, so concurrent ones overlap on the device.
+    # Merging them into one batch is blocked on lina-speech; see Known Limitations in the README.
+    with STAGE_SECONDS.labels("generate_batch").time():
+        return model.generate_batch(txt, device=DEVICE, **kwargs)
+
+
+def decode(codes, crop=0):
+    # One unpadded sequence per WavTokenizer pass: the decoder attends over the whole sequence, so
+    # padding unrelated requests into one batch would change each row's waveform
+    with STAGE_SECONDS.labels("decode").time():
+        features = wavtokenizer.codes_to_features(codes.to(DEVICE))
+        audio_out = wavtokenizer.decode(features, bandwidth_id=bandwidth_id)
+        return audio_out[0, crop * SAMPLES_PER_TOKEN:].cpu().numpy()
+
+
+def wav_stream_header(sample_rate=24000):
+    # RIFF/data sizes are unknown up front; 0xFFFFFFFF is what streaming players expect
+    return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt "
+            + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+            + b"data" + struct.pack("<I", 0xFFFFFFFF))
+
+
+def to_pcm16(audio):
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+def sentence_chunks(sentences):
+    # Text for each streamed chunk as (with prompt transcript, alone): the previous sentence followed
+    # by the current one, and the current one by itself for when there is no usable prompt. All
+    # chunks are tokenized in one batch up front.
+    with_context = ["[BOS]" + (sentence if i == 0 else sentences[i - 1] + " " + sentence) + "[EOS]"
+                    for i, sentence in enumerate(sentences)]
+    alone = ["[BOS]" + sentence + "[EOS]" for sentence in sentences]
+    with STAGE_SECONDS.labels("tokenization").time():
+        encoded = text_tokenizer.encode_batch(with_context + alone)
+    return list(zip(encoded[:len(sentences)], encoded[len(sentences):]))
+
+
+def stream_sentences(chunks, fmt):
+    # Each sentence is generated with the previous sentence's tokens as the prompt (and its text
+    # as the prompt transcript), so voice and prosody carry over. Only one sentence worth of tokens
+    # and audio is alive at a time.
+    if fmt == "wav":
+        yield wav_stream_header()
+
+    overlap = STREAM_OVERLAP_TOKENS * SAMPLES_PER_TOKEN
+    fade_in = np.linspace(0.0, 1.0, overlap, dtype=np.float32)
+    prev_codes, tail = None, None
+    for with_context, alone in chunks:
+        txt = torch.LongTensor(alone if prev_codes is None else with_context).to(DEVICE)
+
+        prompt_len = 0 if prev_codes is None else prev_codes.shape[-1]
+        max_seqlen = seqlen_budget(len(txt), MAX_SEQLEN_VOICE if prompt_len else MAX_SEQLEN_TTS, prompt_len)
+        _, _, _, cuts = generate(txt, batch_size=1, k=100, max_seqlen=max_seqlen, prompt=prev_codes)
+        codes = cuts[0][0]
+
+        # Decode from a few tokens before the prompt ends so the seam can be crossfaded
+        start = max(prompt_len - STREAM_OVERLAP_TOKENS, 0)
+        audio = decode(codes[..., start:])
+
+        if tail is not None:
+            n = min(len(tail), len(audio), (prompt_len - start) * SAMPLES_PER_TOKEN)
+            audio[:n] = tail[:n] * (1 - fade_in[:n]) + audio[:n] * fade_in[:n]
+        # The last few tokens are held back to be crossfaded with the next sentence
+        tail, audio = audio[-overlap:], audio[:-overlap]
+        yield to_pcm16(audio)
+
+        # A sentence that produced no new tokens leaves nothing to prompt with; the next one starts fresh
+        prev_codes = codes[..., prompt_len:] if codes.shape[-1] > prompt_len else None
+
+    if tail is not None:
+        yield to_pcm16(tail)
 
-print("Loading models...")
-model = TrainLina.load_from_checkpoint("check/last.ckpt").model.eval().to("cuda")
-tokenizer = PreTrainedTokenizerFast(tokenizer_file="bpe256.json")
-config_path = "check/wavtokenizer_mediumdata_frame75_3s_nq1_code4096_dim512_kmeans200_attn.yaml"
-model_path = "check/wavtokenizer_medium_speech_320_24k.ckpt"
-wavtokenizer = WavTokenizer.from_pretrained0802(config_path, model_path).to("cuda")
-bandwidth_id = torch.tensor([0], device="cuda")
-print("Models loaded successfully.")
 
 @app.route("/synthesize", methods=["POST"])
 def synthesize():
@@ -27,86 +234,154 @@ def synthesize():
     if not data or "text" not in data:
         return jsonify({"error": "Missing 'text' parameter"}), 400
 
-    text = "[BOS]" + data["text"] + "[EOS]"
-    txt = torch.LongTensor(tokenizer.encode(text)).to("cuda")
+    if request.args.get('stream') in ('1', 'true') or data.get('stream'):
+        fmt = request.args.get('format', 'wav').lower()
+        if fmt not in STREAM_FORMATS:
+            return jsonify({"error": f"Unsupported stream format, use one of: {', '.join(STREAM_FORMATS)}"}), 400
+        sentences = split_sentences(normalize_text(data["text"]))
+        if not sentences:
+            return jsonify({"error": "Empty 'text' parameter"}), 400
+        chunks = sentence_chunks(sentences)
+        return Response(stream_with_context(stream_sentences(chunks, fmt)), mimetype=STREAM_FORMATS[fmt])
+
+    fmt = negotiate_format()
+    if fmt is None:
+        return jsonify({"error": f"Unsupported format, use one of: {', '.join(AUDIO_FORMATS)}"}), 400
 
-    _, _, _, cuts = model.generate_batch(txt, batch_size=1, k=100, max_seqlen=2000, device="cuda")
+    text = "[BOS]" + normalize_text(data["text"]) + "[EOS]"
+    with STAGE_SECONDS.labels("tokenization").time():
+        txt = torch.LongTensor(text_tokenizer.encode(text)).to(DEVICE)
+
+    max_seqlen = seqlen_budget(len(txt), MAX_SEQLEN_TTS)
+    _, _, _, cuts = generate(txt, batch_size=1, k=100, max_seqlen=max_seqlen)
     x = cuts[0]
+    FRAMES_PER_TEXT_TOKEN.observe(x[0].shape[-1] / len(txt))
 
-    features = wavtokenizer.codes_to_features(x[0][..., :].cuda())
-    audio_out = wavtokenizer.decode(features, bandwidth_id=bandwidth_id)
+    audio_numpy = decode(x[0])
+    return audio_response(audio_numpy, fmt)
 
-    if not isinstance(audio_out, torch.Tensor):
-        return jsonify({"error": "Decoded audio is not a valid tensor"}), 500
 
-    audio_numpy = np.squeeze(audio_out.cpu().numpy())
+def encode_prompt(audio_bytes):
+    wav, sr = torchaudio.load(io.BytesIO(audio_bytes))
+    wav = wav.mean(dim=0, keepdim=True) if wav.shape[0] > 1 else wav
+    if sr != 24000:
+        wav = torchaudio.functional.resample(wav, orig_freq=sr, new_freq=24000)
+    _, audio_tokens = wavtokenizer.encode_infer(wav.to(DEVICE), bandwidth_id=bandwidth_id)
+    return audio_tokens
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_wav:
-        sf.write(temp_wav.name, audio_numpy, 24000)
-        temp_filename = temp_wav.name
 
-    return send_file(temp_filename, mimetype="audio/wav", as_attachment=True, download_name="output.wav")
+def cached_prompt(audio_bytes):
+    with STAGE_SECONDS.labels("prompt_encode").time():
+        voice_id, audio_tokens, hit = prompt_cache.get_or_encode(audio_bytes, encode_prompt)
+    (PROMPT_CACHE_HITS if hit else PROMPT_CACHE_MISSES).inc()
+    return voice_id, audio_tokens
 
 
-@app.route("/synthesize_voice", methods=["POST"])
-def synthesize_voice():
-    if 'text' not in request.form or 'audio' not in request.files:
-        return jsonify({"error": "Missing 'text' or 'audio' parameter"}), 400
+def decode_candidates(codes, prompt_len):
+    return [decode(c, crop=prompt_len) for c in codes]
+
 
-    text = request.form.get('text')
-    audio_file = request.files['audio']
-    text_normalized = request.form.get('text_normalized', '')
+def candidate_score(audio, median_len, hit_cap):
+    # Higher is better. Penalises lengths far from the other candidates, long stretches of
+    # silence (mumbling or stalled generation) and rows that never emitted end-of-audio.
+    if len(audio) == 0:
+        return -float('inf')
+    length_penalty = abs(len(audio) - median_len) / max(median_len, 1)
+    frames = audio[:len(audio) // 480 * 480].reshape(-1, 480)  # 20ms frames
+    rms = np.sqrt(np.mean(frames ** 2, axis=1)) if len(frames) else np.zeros(1)
+    silence_ratio = float(np.mean(rms < 0.05 * rms.max())) if rms.max() > 0 else 1.0
+    return -(length_penalty + silence_ratio + (1.0 if hit_cap else 0.0))
 
-    audio_path = os.path.join('Requests', 'input_audio.wav')
-    audio_file.save(audio_path)
+
+def pick_candidate(audios, max_new_tokens):
+    if len(audios) == 1:
+        return 0
+    with STAGE_SECONDS.labels("score").time():
+        median_len = float(np.median([len(a) for a in audios]))
+        scores = [candidate_score(a, median_len, len(a) >= max_new_tokens * SAMPLES_PER_TOKEN) for a in audios]
+    return int(np.argmax(scores))
+
+
+@app.route("/voices", methods=["POST"])
+def register_voice():
+    if 'audio' not in request.files:
+        return jsonify({"error": "Missing 'audio' parameter"}), 400
 
     try:
-        wav, sr = torchaudio.load(audio_path)
+        voice_id, audio_tokens = cached_prompt(request.files['audio'].read())
     except Exception as e:
         return jsonify({"error": f"Failed to load audio: {str(e)}"}), 400
 
+    return jsonify({"voice_id": voice_id, "prompt_tokens": audio_tokens.shape[-1]})
+
+
+@app.route("/synthesize_voice", methods=["POST"])
+def synthesize_voice():
+    if 'text' not in request.form or ('audio' not in request.files and 'voice_id' not in request.form):
+        return jsonify({"error": "Missing 'text' or 'audio'/'voice_id' parameter"}), 400
+
+    fmt = negotiate_format()
+    if fmt is None:
+        return jsonify({"error": f"Unsupported format, use one of: {', '.join(AUDIO_FORMATS)}"}), 400
+
     try:
-        wav, sr = torchaudio.load(audio_path)
-        wav = wav.to("cuda")
-        bandwidth_id = torch.tensor([0]).cuda()
-        _, audio_tokens = wavtokenizer.encode_infer(wav, bandwidth_id=bandwidth_id)
+        candidates = int(request.form.get('candidates', DEFAULT_CANDIDATES))
+    except ValueError:
+        return jsonify({"error": "'candidates' must be an integer"}), 400
+    if not 1 <= candidates <= MAX_CANDIDATES:
+        return jsonify({"error": f"'candidates' must be between 1 and {MAX_CANDIDATES}"}), 400
+
+    text = normalize_text(request.form.get('text'))
+    text_normalized = normalize_text(request.form.get('text_normalized', ''))
 
+    # A registered voice skips the upload and the WavTokenizer encoder entirely
+    if 'voice_id' in request.form:
+        voice_id = request.form['voice_id']
+        if not PromptCache.valid_key(voice_id):
+            return jsonify({"error": "'voice_id' must be the 64-character id returned by /voices"}), 400
+        audio_tokens = prompt_cache.get(voice_id)
+        if audio_tokens is None:
+            return jsonify({"error": "Unknown voice_id, register the voice again"}), 404
+        PROMPT_CACHE_HITS.inc()
+    else:
+        with STAGE_SECONDS.labels("upload_save").time():
+            audio_bytes = request.files['audio'].read()
+        try:
+            _, audio_tokens = cached_prompt(audio_bytes)
+        except Exception as e:
+            return jsonify({"error": f"Failed to load audio: {str(e)}"}), 400
+
+    try:
+        audio_tokens = audio_tokens.to(DEVICE)
         print(f"Your audio tokens shape: {audio_tokens.shape}")
 
         txt = "[BOS]" + text_normalized + " " + text + "[EOS]"
-        txt_encoded = torch.LongTensor(tokenizer.encode(txt)).to("cuda")
+        with STAGE_SECONDS.labels("tokenization").time():
+            txt_encoded = torch.LongTensor(text_tokenizer.encode(txt)).to(DEVICE)
         print(f"Text input shape: {txt_encoded.shape}")
 
-        # Generate
-        batch_size = 4
-        _, atts, _, cuts = model.generate_batch(
+        prompt_len = audio_tokens.shape[-1]
+        max_seqlen = seqlen_budget(len(txt_encoded), MAX_SEQLEN_VOICE, prompt_len)
+        _, atts, _, cuts = generate(
             txt_encoded,
-            batch_size=batch_size,
+            batch_size=candidates,
             k=400,
-            max_seqlen=4000,
+            max_seqlen=max_seqlen,
             prompt=audio_tokens,
-            device="cuda",
         )
 
-        cut_t = audio_tokens.shape[-1]/75
+        audios = decode_candidates([x[0] for x in cuts], prompt_len)
         for x in cuts:
-            features = wavtokenizer.codes_to_features(x[0][..., :].cuda())
-            audio_out = wavtokenizer.decode(features, bandwidth_id=bandwidth_id)
-            audio_out = audio_out[:, int(cut_t * 24000):]  # Crop first
-            break;
-
-        audio_numpy = np.squeeze(audio_out.cpu().numpy())
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_wav:
-            sf.write(temp_wav.name, audio_numpy, 24000)
-            temp_filename = temp_wav.name
-
-        return send_file(temp_filename, mimetype="audio/wav", as_attachment=True, download_name="output.wav")
-        
+            FRAMES_PER_TEXT_TOKEN.observe((x[0].shape[-1] - prompt_len) / len(txt_encoded))
+        audio_numpy = audios[pick_candidate(audios, max_seqlen - prompt_len)]
+        return audio_response(audio_numpy, fmt)
 
     except Exception as e:
         return jsonify({"error": f"Processing failed: {str(e)}"}), 500
 
+# Models load in the background so /healthz answers while they warm up
+service.start(startup)
+
 if __name__ == "__main__":
     print("Starting ngrok...")
     ngrok.set_auth_token("YOUR_AUTH_TOKEN")
@@ -0,0 +1,96 @@
+import argparse
+import csv
+import os
+import time
+import numpy as np
+import torch
+
+
+DEFAULT_TEXTS = [
+    "Hello there.",
+    "Welcome to today's lecture on the basics of signal processing.",
+    "In this session we will look at how sampling, quantization and filtering work together, "
+    "and why each of them matters when we record and reproduce speech.",
+]
+
+
+def synthesize_once(server, text):
+    txt = torch.LongTensor(server.text_tokenizer.encode("[BOS]" + text + "[EOS]")).to(server.DEVICE)
+    max_seqlen = server.seqlen_budget(len(txt), server.MAX_SEQLEN_TTS)
+    start = time.perf_counter()
+    _, _, _, cuts = server.generate(txt, batch_size=1, k=100, max_seqlen=max_seqlen)
+    audio = server.decode(cuts[0][0])
+    elapsed = time.perf_counter() - start
+    return elapsed, len(audio) / 24000
+
+
+def run_mode(server, mode, texts, repeats):
+    rows = []
+    for i, text in enumerate(texts):
+        timings, durations = [], []
+        for repeat in range(repeats):
+            # Sampling is stochastic, so RTF is computed per run against that run's audio length
+            torch.manual_seed(repeat)
+            elapsed, duration = synthesize_once(server, text)
+            timings.append(elapsed)
+            durations.append(duration)
+            print(f"⏱️{mode}, text {i + 1}, run {repeat + 1}/{repeats}: {elapsed:.2f}s for {duration:.2f}s of audio")
+        rtfs = [t / d for t, d in zip(timings, durations) if d > 0]
+        rows.append({
+            "mode": mode,
+            "text": i + 1,
+            "text_chars": len(text),
+            "latency_s": round(float(np.median(timings)), 2),
+            "audio_s": round(float(np.median(durations)), 2),
+            "rtf": round(float(np.median(rtfs)), 3) if rtfs else float('nan'),
+        })
+    return rows
+
+
+def main(args):
+    os.environ['SMALLE_DEVICE'] = args.device
+    os.environ['SMALLE_QUANTIZE'] = '0'
+    if args.threads:
+        os.environ['SMALLE_NUM_THREADS'] = str(args.threads)
+    # Imported late so the settings are picked up when the server module loads its models
+    import app as server
+    while not server.service.ready.wait(1):
+        if server.service.startup_error:
+            raise SystemExit(f"Model loading failed: {server.service.startup_error}")
+
+    texts = args.text or DEFAULT_TEXTS
+    rows = []
+    # fp32 first, since quantization replaces the loaded modules in place
+    if 'fp32' in args.modes:
+        rows += run_mode(server, 'fp32', texts, args.repeats)
+    if 'int8' in args.modes:
+        server.quantize_models()
+        server.warmup()
+        rows += run_mode(server, 'int8', texts, args.repeats)
+
+    print(f"{'mode':>5} {'text':>5} {'chars':>6} {'latency_s':>10} {'audio_s':>8} {'rtf':>7}")
+    for row in rows:
+        print(f"{row['mode']:>5} {row['text']:>5} {row['text_chars']:>6} {row['latency_s']:>10} {row['audio_s']:>8} {row['rtf']:>7}")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Real-time factor of Small-E synthesis, fp32 vs. dynamic int8.")
+    parser.add_argument("--text", type=str, nargs='+', default=None, help="Texts to synthesize; a short/medium/long set by default.")
+    parser.add_argument("--modes", type=str, nargs='+', default=None, choices=['fp32', 'int8'], help="Precisions to compare; both on CPU, fp32 elsewhere by default.")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per text; the median is reported.")
+    parser.add_argument("--device", type=str, default='cpu', help="Device to benchmark on (int8 is CPU-only).")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads; PyTorch's default if unset.")
+    parser.add_argument("--csv", type=str, default=None, help="Optional CSV file for the results.")
+    args = parser.parse_args()
+    # quantize_models() leaves the model in fp32 off CPU, which would be reported as int8
+    if args.modes is None:
+        args.modes = ['fp32', 'int8'] if args.device == 'cpu' else ['fp32']
+    elif 'int8' in args.modes and args.device != 'cpu':
+        parser.error("int8 is CPU-only, use --device cpu or --modes fp32")
+    main(args)
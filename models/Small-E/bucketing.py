@@ -0,0 +1,63 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthBucketSampler(Sampler):
+    # Batch sampler that groups utterances of similar length so little of each batch is padding.
+    # Indices are shuffled, cut into buckets of a few hundred items, sorted by (audio, text) length
+    # inside each bucket and split into batches; the batch order is shuffled again every epoch.
+    # With max_tokens set, batches are filled up to that many padded audio tokens instead of a
+    # fixed batch_size, so short clips travel in large batches and long ones in small batches.
+
+    def __init__(self, lengths, text_lengths=None, batch_size=8, max_tokens=None, bucket_batches=100,
+                 shuffle=True, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.text_lengths = np.zeros_like(self.lengths) if text_lengths is None else np.asarray(text_lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_batches * batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def split(self, bucket):
+        if self.max_tokens is None:
+            batches = [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+            if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+                batches.pop()
+            return batches
+
+        batches, current, longest = [], [], 0
+        for idx in bucket:
+            longest_with = max(longest, self.lengths[idx])
+            if current and longest_with * (len(current) + 1) > self.max_tokens:
+                batches.append(current)
+                current, longest_with = [], self.lengths[idx]
+            current.append(idx)
+            longest = longest_with
+        if current:
+            batches.append(current)
+        return batches
+
+    def batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.lexsort((self.text_lengths[bucket], self.lengths[bucket]))]
+            batches.extend(self.split(bucket.tolist()))
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches(self.epoch))
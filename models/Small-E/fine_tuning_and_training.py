@@ -12,6 +12,8 @@ from model.modeling_lina import LinaModel
 from model.encoder import TextEncoder
 from decoder.pretrained import WavTokenizer
 from train_lina import TrainLina
+from token_shards import TokenShardDataset, shards_available
+from bucketing import LengthBucketSampler
 from pytorch_lightning.callbacks import ModelCheckpoint, LearningRateMonitor
 
 # Configuration
@@ -24,16 +26,17 @@ TRAINING_STEPS = 500000
 CHECKPOINT_DIR = "checkpoints/"
 MAX_AUDIO_LEN = 1500
 MAX_TEXT_LEN = 120
+DATASET_CSV = "/home/kmit/Desktop/PS-Projects/G331/lina-speech/dataset/train.csv"
+AUDIO_DIR = "/home/kmit/Desktop/PS-Projects/G331/lina-speech/dataset/audio"
+# Written once by precompute_codes.py; when present, training never touches the audio or WavTokenizer
+SHARD_DIR = "/home/kmit/Desktop/PS-Projects/G331/lina-speech/dataset/token_shards"
+NUM_WORKERS = 4
+# With shards, batches are drawn from length buckets; set MAX_TOKENS to fill each batch up to
+# that many padded audio tokens instead of a fixed BATCH_SIZE
+MAX_TOKENS = None
 
 os.makedirs(CHECKPOINT_DIR, exist_ok=True)
 
-# Load WavTokenizer
-config_path = hf_hub_download("novateur/WavTokenizer-medium-speech-75token", "wavtokenizer_mediumdata_frame75_3s_nq1_code4096_dim512_kmeans200_attn.yaml")
-model_path = hf_hub_download("novateur/WavTokenizer-medium-speech-75token", "wavtokenizer_medium_speech_320_24k.ckpt")
-wavtokenizer = WavTokenizer.from_pretrained0802(config_path, model_path).to("cuda")
-tokenizer = PreTrainedTokenizerFast(tokenizer_file="bpe256.json")
-bandwidth_id = torch.tensor([0], requires_grad=False)
-
 class NPTELDataset(Dataset):
     def __init__(self, csv_file, audio_dir, tokenizer, wavtokenizer, bandwidth_id):
         self.data = pd.read_csv(csv_file, names=['audio_path', 'text'])
@@ -85,15 +88,13 @@ class NPTELDataset(Dataset):
 
 
 def collate_fn(batch):
+    # Only tokens and lengths leave the workers; the masks are rebuilt on the device from
+    # `lengths` in LinaModelPL.forward instead of shipping a dense (B, T, T) tensor every step
     batch = [b for b in batch if b["seq_len"] > 0]
     if not batch:
         return {
             "text_token": torch.zeros((1, 1), dtype=torch.long),
             "audio_token": torch.zeros((1, 1, 1), dtype=torch.long),  # Keep 3D structure
-            "crossatt_mask": torch.zeros((1, 1, 1), dtype=torch.bool),
-            "crossatt_pos": torch.zeros((1, 1), dtype=torch.long),
-            "encoder_mask": torch.zeros((1, 1), dtype=torch.bool),
-            "y_mask": torch.zeros((1, 1, 1), dtype=torch.bool),
             "padding_mask": torch.zeros((1), dtype=torch.bool),
             "lengths": torch.zeros((1), dtype=torch.long)
         }
@@ -108,12 +109,8 @@ def collate_fn(batch):
     # Where num_quantizers is 1 in this case
     audio_tokens = torch.zeros((batch_size, 1, max_audio_len), dtype=torch.long)
     text_tokens = torch.zeros((batch_size, max_text_len), dtype=torch.long)
-    encoder_mask = torch.zeros((batch_size, max_audio_len), dtype=torch.bool)
-    crossatt_mask = torch.zeros((batch_size, max_audio_len, max_audio_len), dtype=torch.bool)
-    y_mask = torch.zeros((batch_size, 1, max_audio_len), dtype=torch.bool)
     padding_mask = torch.ones(batch_size, dtype=torch.bool)
     lengths = torch.tensor([min(l, MAX_AUDIO_LEN) for l in audio_lens], dtype=torch.long)
-    crossatt_pos = torch.arange(max_audio_len).unsqueeze(0).repeat(batch_size, 1)
 
     for i, b in enumerate(batch):
         a_len = min(b["seq_len"], max_audio_len)
@@ -121,23 +118,28 @@ def collate_fn(batch):
         # Keep the 3D structure
         audio_tokens[i, :, :a_len] = b["audio_token"][:, :a_len]
         text_tokens[i, :t_len] = b["text_token"][:t_len]
-        encoder_mask[i, :a_len] = True
-        crossatt_mask[i, :a_len, :a_len] = True
-        y_mask[i, :, :a_len] = True
 
     print("text_token:", text_tokens.shape)
     print("audio_token:", audio_tokens.shape)
     return {
         "text_token": text_tokens,
         "audio_token": audio_tokens,  # Keep as 3D
-        "crossatt_mask": crossatt_mask,
-        "crossatt_pos": crossatt_pos,
-        "encoder_mask": encoder_mask,
-        "y_mask": y_mask,
         "padding_mask": padding_mask,
         "lengths": lengths
     }
 
+
+def build_masks(batch):
+    # Same masks collate_fn used to materialize on the host, derived from the per-item lengths
+    batch_size, _, max_audio_len = batch["audio_token"].shape
+    positions = torch.arange(max_audio_len, device=batch["lengths"].device)
+    encoder_mask = positions.unsqueeze(0) < batch["lengths"].unsqueeze(1)
+    batch["encoder_mask"] = encoder_mask
+    batch["crossatt_mask"] = encoder_mask.unsqueeze(2) & encoder_mask.unsqueeze(1)
+    batch["crossatt_pos"] = positions.unsqueeze(0).expand(batch_size, -1)
+    batch["y_mask"] = encoder_mask.unsqueeze(1)
+    return batch
+
 class LinaModelPL(pl.LightningModule):
     def __init__(self, checkpoint_path=None):
         super().__init__()
@@ -171,7 +173,7 @@ class LinaModelPL(pl.LightningModule):
             print(f"Checkpoint load failed: {e}")
 
     def forward(self, batch):
-        batch = {k: v.to(self.device) for k, v in batch.items()}
+        batch = build_masks({k: v.to(self.device) for k, v in batch.items()})
         try:
             loss = self.model(batch)
             if torch.isnan(loss) or torch.isinf(loss):
@@ -192,19 +194,36 @@ class LinaModelPL(pl.LightningModule):
         return self.model.configure_optimizers()
 
 # Load dataset and dataloader
-train_dataset = NPTELDataset(
-    "/home/kmit/Desktop/PS-Projects/G331/lina-speech/dataset/train.csv",
-    "/home/kmit/Desktop/PS-Projects/G331/lina-speech/dataset/audio",
-    tokenizer, wavtokenizer, bandwidth_id
-)
+if shards_available(SHARD_DIR):
+    print(f"Using precomputed token shards from {SHARD_DIR}")
+    train_dataset = TokenShardDataset(SHARD_DIR, max_audio_len=MAX_AUDIO_LEN)
+    # Items are memmap slices, so workers are cheap and keep the GPU fed
+    num_workers = NUM_WORKERS
+    # Lengths come from the shard indexes, so batches can be grouped by length up front
+    batch_sampler = LengthBucketSampler(
+        train_dataset.lengths(), train_dataset.text_lengths(),
+        batch_size=BATCH_SIZE, max_tokens=MAX_TOKENS, shuffle=True
+    )
+    loader_args = {"batch_sampler": batch_sampler}
+else:
+    print(f"No token shards at {SHARD_DIR}, encoding audio on the fly (run precompute_codes.py to avoid this)")
+    config_path = hf_hub_download("novateur/WavTokenizer-medium-speech-75token", "wavtokenizer_mediumdata_frame75_3s_nq1_code4096_dim512_kmeans200_attn.yaml")
+    model_path = hf_hub_download("novateur/WavTokenizer-medium-speech-75token", "wavtokenizer_medium_speech_320_24k.ckpt")
+    wavtokenizer = WavTokenizer.from_pretrained0802(config_path, model_path).to("cuda")
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file="bpe256.json")
+    bandwidth_id = torch.tensor([0], requires_grad=False)
+    train_dataset = NPTELDataset(DATASET_CSV, AUDIO_DIR, tokenizer, wavtokenizer, bandwidth_id)
+    # The dataset encodes on the GPU, which cannot be shared with forked workers
+    num_workers = 0
+    loader_args = {"batch_size": BATCH_SIZE, "shuffle": True, "drop_last": False}
 
 train_loader = DataLoader(
     train_dataset,
-    batch_size=BATCH_SIZE,
-    shuffle=True,
-    num_workers=0,
+    num_workers=num_workers,
+    pin_memory=num_workers > 0,
+    persistent_workers=num_workers > 0,
     collate_fn=collate_fn,
-    drop_last=False
+    **loader_args
 )
 
 # Setup model and training
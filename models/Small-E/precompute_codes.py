@@ -0,0 +1,64 @@
+import argparse
+import os
+import pandas as pd
+import torch
+import torchaudio
+from transformers import PreTrainedTokenizerFast
+from huggingface_hub import hf_hub_download
+from decoder.pretrained import WavTokenizer
+from token_shards import ShardWriter, shards_available
+
+
+def main(args):
+    if shards_available(args.output):
+        raise SystemExit(f"{args.output} already holds shards, remove it or choose another --output")
+
+    config_path = hf_hub_download("novateur/WavTokenizer-medium-speech-75token", "wavtokenizer_mediumdata_frame75_3s_nq1_code4096_dim512_kmeans200_attn.yaml")
+    model_path = hf_hub_download("novateur/WavTokenizer-medium-speech-75token", "wavtokenizer_medium_speech_320_24k.ckpt")
+    wavtokenizer = WavTokenizer.from_pretrained0802(config_path, model_path).to(args.device)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_file=args.tokenizer)
+    bandwidth_id = torch.tensor([0], device=args.device)
+
+    data = pd.read_csv(args.csv, names=['audio_path', 'text'])
+    audio_dir = os.path.abspath(args.audio_dir)
+    writer = ShardWriter(args.output, shard_size=args.shard_size)
+    resamplers = {}
+    failed = 0
+
+    for idx, row in data.iterrows():
+        audio_path = os.path.join(audio_dir, row['audio_path'])
+        try:
+            wav, sr = torchaudio.load(audio_path)
+            wav = wav.mean(dim=0, keepdim=True) if wav.shape[0] > 1 else wav
+            if sr != 24000:
+                # One resampler per source rate; building the kernel is most of its cost
+                if sr not in resamplers:
+                    resamplers[sr] = torchaudio.transforms.Resample(orig_freq=sr, new_freq=24000)
+                wav = resamplers[sr](wav)
+
+            with torch.no_grad():
+                _, audio_token = wavtokenizer.encode_infer(wav.to(args.device), bandwidth_id=bandwidth_id)
+        except Exception as e:
+            print(f"Failed to process {audio_path}: {e}")
+            failed += 1
+            continue
+
+        text_token = tokenizer.encode(f"[BOS]{row['text']}[EOS]")
+        writer.add(row['audio_path'], audio_token.cpu().numpy(), text_token)
+        if (idx + 1) % 1000 == 0:
+            print(f"Encoded {idx + 1}/{len(data)} clips")
+
+    writer.close()
+    print(f"✅ Encoded {len(data) - failed} clips into {args.output} ({failed} failed)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode a CSV corpus into WavTokenizer code shards for fine-tuning.")
+    parser.add_argument("--csv", type=str, required=True, help="CSV of audio_path,text rows, as used for training.")
+    parser.add_argument("--audio_dir", type=str, required=True, help="Directory the audio paths are relative to.")
+    parser.add_argument("--output", type=str, required=True, help="Directory the shards are written to.")
+    parser.add_argument("--tokenizer", type=str, default="bpe256.json", help="BPE tokenizer file.")
+    parser.add_argument("--shard_size", type=int, default=10000, help="Utterances per shard.")
+    parser.add_argument("--device", type=str, default="cuda", help="Device WavTokenizer encodes on.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,67 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+
+class PromptCache:
+    # LRU of WavTokenizer prompt tokens keyed by the SHA-256 of the reference audio.
+    # With persist_dir set, entries are also written to disk and survive restarts.
+
+    def __init__(self, max_entries=64, persist_dir=None):
+        self.max_entries = max_entries
+        self.persist_dir = persist_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    @staticmethod
+    def key(audio_bytes):
+        return hashlib.sha256(audio_bytes).hexdigest()
+
+    @staticmethod
+    def valid_key(key):
+        # Keys end up in a file path, so anything but a SHA-256 hex digest is refused
+        return isinstance(key, str) and re.fullmatch(r"[0-9a-f]{64}", key) is not None
+
+    def disk_path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.pt")
+
+    def get(self, key):
+        if not self.valid_key(key):
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.persist_dir and os.path.exists(self.disk_path(key)):
+            tokens = torch.load(self.disk_path(key), map_location="cpu")
+            self.put(key, tokens, persist=False)
+            return tokens
+        return None
+
+    def put(self, key, tokens, persist=True):
+        tokens = tokens.cpu()
+        with self.lock:
+            self.entries[key] = tokens
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        if persist and self.persist_dir:
+            tmp_path = f"{self.disk_path(key)}.{threading.get_ident()}.tmp"
+            torch.save(tokens, tmp_path)
+            os.replace(tmp_path, self.disk_path(key))
+
+    def get_or_encode(self, audio_bytes, encode):
+        key = self.key(audio_bytes)
+        tokens = self.get(key)
+        hit = tokens is not None
+        if not hit:
+            tokens = encode(audio_bytes)
+            self.put(key, tokens)
+        return key, tokens, hit
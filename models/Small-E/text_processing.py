@@ -0,0 +1,66 @@
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?।])\s+')
+# Fragments shorter than this ("Dr.", "e.g.", "Yes.") are merged into the next sentence, so
+# abbreviations are not split off and no streamed chunk is too short to carry prosody
+MIN_SENTENCE_CHARS = 20
+
+
+def normalize_text(text):
+    # Canonical Unicode form and single spaces, so equal transcripts hit the same memo entries
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def split_sentences(text):
+    sentences, pending = [], ""
+    for part in SENTENCE_END.split(text.strip()):
+        pending = f"{pending} {part.strip()}".strip()
+        if len(pending) >= MIN_SENTENCE_CHARS:
+            sentences.append(pending)
+            pending = ""
+    if pending:
+        if sentences:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+    return sentences
+
+
+class TextTokenizer:
+    # Batched BPE encoding with an LRU memo in front. The memo is keyed by the whole string, so it
+    # only hits on exact repeats (the same synthesis text, streamed chunks that recur); prompts that
+    # combine a voice's transcript with new text differ per job and are always tokenized. The
+    # transcript is not encoded on its own because BPE merges across the join could then differ.
+
+    def __init__(self, tokenizer, max_entries=4096):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode_batch(self, texts):
+        results = {}
+        with self.lock:
+            for text in texts:
+                if text in self.entries:
+                    self.entries.move_to_end(text)
+                    results[text] = self.entries[text]
+
+        missing = list(dict.fromkeys(text for text in texts if text not in results))
+        if missing:
+            encoded = self.tokenizer(missing)["input_ids"]
+            with self.lock:
+                for text, ids in zip(missing, encoded):
+                    results[text] = self.entries[text] = tuple(ids)
+                    self.entries.move_to_end(text)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        return [list(results[text]) for text in texts]
+
+    def encode(self, text):
+        return self.encode_batch([text])[0]
@@ -0,0 +1,108 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+# Codebook (4096) and BPE (256) ids both fit in int16, a quarter of the int64 the model consumes
+TOKEN_DTYPE = np.int16
+
+
+def shard_dirs(root):
+    return sorted(os.path.join(root, name) for name in os.listdir(root)
+                  if name.startswith("shard_") and not name.endswith(".tmp"))
+
+
+def shards_available(root):
+    return os.path.isdir(root) and len(shard_dirs(root)) > 0
+
+
+class ShardWriter:
+    # Accumulates encoded utterances and writes them as fixed-size shards. Each shard holds the
+    # concatenated codes and text tokens plus offset indexes, so any item is two memmap slices.
+
+    def __init__(self, root, shard_size=10000):
+        self.root = root
+        self.shard_size = shard_size
+        self.shard_index = len(shard_dirs(root)) if os.path.isdir(root) else 0
+        self.reset()
+        os.makedirs(root, exist_ok=True)
+
+    def reset(self):
+        self.codes, self.texts, self.names = [], [], []
+
+    def add(self, name, codes, text_tokens):
+        self.codes.append(np.asarray(codes, dtype=TOKEN_DTYPE).reshape(-1))
+        self.texts.append(np.asarray(text_tokens, dtype=TOKEN_DTYPE).reshape(-1))
+        self.names.append(name)
+        if len(self.names) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.names:
+            return
+        shard_dir = os.path.join(self.root, f"shard_{self.shard_index:05d}")
+        tmp_dir = shard_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for prefix, arrays in (("codes", self.codes), ("text", self.texts)):
+            offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+            np.cumsum([len(a) for a in arrays], out=offsets[1:])
+            np.save(os.path.join(tmp_dir, f"{prefix}.npy"), np.concatenate(arrays))
+            np.save(os.path.join(tmp_dir, f"{prefix}_offsets.npy"), offsets)
+        with open(os.path.join(tmp_dir, "names.json"), "w") as f:
+            json.dump(self.names, f)
+        # A shard only becomes visible once complete, so an interrupted run never leaves a partial one
+        os.rename(tmp_dir, shard_dir)
+        print(f"💾 Wrote {shard_dir} ({len(self.names)} utterances)")
+        self.shard_index += 1
+        self.reset()
+
+    def close(self):
+        self.flush()
+
+
+class TokenShardDataset(Dataset):
+    # Reads items straight out of memory-mapped shards; nothing is decoded or encoded at train time.
+    # Items have the same layout as NPTELDataset so collate_fn works unchanged.
+
+    def __init__(self, root, max_audio_len=None):
+        self.max_audio_len = max_audio_len
+        self.shards = []
+        self.index = []
+        for shard_dir in shard_dirs(root):
+            shard = {
+                name: np.load(os.path.join(shard_dir, f"{name}.npy"), mmap_mode="r")
+                for name in ("codes", "codes_offsets", "text", "text_offsets")
+            }
+            with open(os.path.join(shard_dir, "names.json")) as f:
+                shard["names"] = json.load(f)
+            self.index.extend((len(self.shards), i) for i in range(len(shard["names"])))
+            self.shards.append(shard)
+
+    def __len__(self):
+        return len(self.index)
+
+    def lengths(self):
+        # Per-item code lengths from the offset indexes alone, without reading any codes
+        lengths = np.concatenate([np.diff(shard["codes_offsets"]) for shard in self.shards])
+        return np.minimum(lengths, self.max_audio_len) if self.max_audio_len else lengths
+
+    def text_lengths(self):
+        return np.concatenate([np.diff(shard["text_offsets"]) for shard in self.shards])
+
+    def __getitem__(self, idx):
+        shard_id, i = self.index[idx]
+        shard = self.shards[shard_id]
+        start, end = shard["codes_offsets"][i], shard["codes_offsets"][i + 1]
+        if self.max_audio_len:
+            end = min(end, start + self.max_audio_len)
+        text_start, text_end = shard["text_offsets"][i], shard["text_offsets"][i + 1]
+
+        audio_token = torch.from_numpy(shard["codes"][start:end].astype(np.int64)).unsqueeze(0)
+        return {
+            "text_token": torch.from_numpy(shard["text"][text_start:text_end].astype(np.int64)),
+            "audio_token": audio_token,
+            "seq_len": audio_token.shape[-1],
+            "audio_path": shard["names"][i],
+        }
@@ -0,0 +1,104 @@
+import os
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from flask import Response, request, jsonify, g
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+
+# Latencies range from milliseconds (uploads, tokenization) to many minutes (generation, matting long videos)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Probes and scrapes are neither tracked as traffic nor held back while models load
+UNTRACKED_ENDPOINTS = ("healthz", "readyz", "metrics")
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class ModelService:
+    # Startup phase, health endpoints and request metrics shared by the model servers.
+    # Models load on a background thread so /healthz answers while they warm up; every other
+    # endpoint (apart from public_endpoints) gets a 503 until that thread has finished.
+
+    def __init__(self, app, namespace, public_endpoints=()):
+        self.startup_times = {}
+        self.startup_error = None
+        self.ready = threading.Event()
+        self.open_endpoints = UNTRACKED_ENDPOINTS + tuple(public_endpoints)
+
+        self.stage_seconds = Histogram("stage_seconds", "Time spent in each processing stage", ["stage"],
+                                       namespace=namespace, buckets=STAGE_BUCKETS)
+        self.in_flight = Gauge("requests_in_flight", "Requests currently being handled", namespace=namespace)
+        self.bytes_in = Counter("request_bytes_in", "Bytes received in request bodies", namespace=namespace)
+        self.bytes_out = Counter("response_bytes_out", "Bytes sent in response bodies", namespace=namespace)
+        self.request_rss = Histogram("request_end_rss_bytes", "Process RSS when a request finishes", namespace=namespace,
+                                     buckets=tuple(2 ** i * 1024 ** 3 // 8 for i in range(10)))
+        self.peak_rss = Gauge("peak_rss_bytes", "Peak RSS of the process", namespace=namespace)
+        self.peak_rss.set_function(lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+        app.before_request(self.track_request_start)
+        app.before_request(self.require_ready)
+        app.after_request(self.track_bytes_out)
+        app.teardown_request(self.track_request_end)
+        app.add_url_rule('/healthz', 'healthz', self.healthz, methods=['GET'])
+        app.add_url_rule('/readyz', 'readyz', self.readyz, methods=['GET'])
+        app.add_url_rule('/metrics', 'metrics', self.metrics, methods=['GET'])
+
+    @contextmanager
+    def startup_stage(self, name):
+        # Per-stage startup timings, served on /readyz
+        start = time.perf_counter()
+        yield
+        self.startup_times[name] = round(time.perf_counter() - start, 3)
+        print(f"⏱️ {name} took {self.startup_times[name]}s")
+
+    def run_startup(self, load):
+        try:
+            with self.startup_stage("total"):
+                load()
+            self.ready.set()
+            print("✅ Ready to serve")
+        except Exception as e:
+            self.startup_error = str(e)
+            print(f"❌ Startup failed: {e}")
+
+    def start(self, load):
+        threading.Thread(target=self.run_startup, args=(load,), daemon=True).start()
+
+    def track_request_start(self):
+        if request.endpoint in UNTRACKED_ENDPOINTS:
+            return
+        g.tracked = True
+        self.in_flight.inc()
+        self.bytes_in.inc(request.content_length or 0)
+
+    def track_bytes_out(self, response):
+        if g.get('tracked'):
+            self.bytes_out.inc(response.content_length or 0)
+        return response
+
+    def track_request_end(self, exc):
+        if g.pop('tracked', False):
+            self.in_flight.dec()
+            self.request_rss.observe(current_rss())
+
+    def require_ready(self):
+        if request.endpoint not in self.open_endpoints and not self.ready.is_set():
+            return jsonify({"error": "Models are still loading"}), 503
+
+    def healthz(self):
+        if self.startup_error:
+            return jsonify({"status": "failed", "error": self.startup_error}), 500
+        return jsonify({"status": "ok"})
+
+    def readyz(self):
+        status = 200 if self.ready.is_set() else 503
+        return jsonify({"ready": self.ready.is_set(), "startup_times": self.startup_times,
+                        "error": self.startup_error}), status
+
+    def metrics(self):
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)